@@ -1,17 +1,39 @@
-from flask import Flask, render_template, request
+import os
+from flask import Flask, make_response, render_template, request
+from basic_query import BasicQuery
+
+"""command to serve the GUI with a production WSGI server instead of start_GUI:
+    CORPUS_PATH=/Users/kaylakim/Desktop/WEBPAGES_RAW gunicorn -w 4 -k gthread 'GUI:create_app()'"""
 
 app = Flask(__name__)
 query = None
 
-def start_GUI(basic_query):
 
-    """starts the server, allows user to input their query and get results"""
-    @app.route("/", methods=["GET", "POST"])
-    def search():
-        if request.method == "POST":
-            user_query = request.form["query"]
-            urls = basic_query.query_index(user_query)
-            return render_template("results.html", user_query=user_query, urls=urls)
-        return render_template("search_engine.html")
+"""builds the BasicQuery from CORPUS_PATH when a WSGI server loads the app, once per worker process"""
+def create_app():
+    global query
+    corpus_path = os.environ.get("CORPUS_PATH")
+    if not corpus_path:                                # fail at worker start instead of on every search
+        raise RuntimeError("CORPUS_PATH must be set to serve the GUI with create_app")
+    query = BasicQuery(corpus_path)                    # loads the bookkeeping map before the first request
+    return app
+
+
+"""allows user to input their query and get results"""
+@app.route("/", methods=["GET", "POST"])
+def search():
+    if request.method == "POST":
+        user_query = request.form["query"]
+        urls = query.query_index(user_query)
+        response = make_response(render_template("results.html", user_query=user_query, urls=urls))
+        response.headers["Cache-Control"] = "private, max-age=300"     # lets the browser reuse results, e.g. on back navigation
+        return response
+    return render_template("search_engine.html")
+
+
+def start_GUI(basic_query):
 
-    app.run(debug=True)
\ No newline at end of file
+    """starts the server with an already loaded BasicQuery"""
+    global query
+    query = basic_query
+    app.run()
@@ -1,12 +1,15 @@
 import json
 import os
-import nltk
 import re
 from pymongo import MongoClient
-from collections import defaultdict
-from math import log, sqrt
+from collections import Counter, defaultdict
+from functools import lru_cache
+from math import sqrt
 from nltk.stem.snowball import EnglishStemmer
 
+stem = lru_cache(maxsize=200_000)(EnglishStemmer().stem)   # memoized stemmer shared by querying and indexing
+TOKEN_RE = re.compile(r'[A-Za-z0-9]+')                      # a token is a run of letters and digits
+
 class BasicQuery:
     def __init__(self, directory, bookkeeping="bookkeeping.json"):
         self.client = MongoClient("localhost", 27017)
@@ -14,8 +17,9 @@ class BasicQuery:
         self.collection = self.db.inverted_index        #inverted_index is the name of the specific collection
         self.bookkeeping = bookkeeping
         self.directory = directory
-        self.stemmer = EnglishStemmer()
-        self.total_docs = len(self.collection.distinct("docs.location"))
+        self.bookkeeping_map = self.load_bookkeeping()  # {doc_id : url}, parsed once instead of per lookup
+        self.collection.create_index('lemma', unique=True)  # index-backed lookups for the $in query in process_query
+        self.cached_urls = lru_cache(maxsize=1024)(self.rank_urls)  # repeated queries are answered without the database
 
 
     """formats the urls with the complete protocol"""
@@ -31,94 +35,84 @@ class BasicQuery:
 
     """returns a list of urls that match the query"""
     def query_index(self, query):
+        normalized = ' '.join(sorted(TOKEN_RE.findall(query.lower())))    # queries with the same terms share a cache entry
+        return list(self.cached_urls(normalized))
+
+
+    """returns the urls that match a normalized query, cached by query_index"""
+    def rank_urls(self, query):
         results = self.calculate_cosine_similarity(query)
-        urls = [self.get_url(doc_id) for doc_id in results] if results else []
-        return self.format_urls(urls)
+        urls = [url for url in map(self.get_url, results) if url]   # doc_ids missing from bookkeeping have no url
+        return tuple(self.format_urls(urls))
 
 
-    """returns a list of urls associated with given doc_id"""
-    def get_url(self, doc_id):
+    """loads the bookkeeping file mapping each doc_id to its url"""
+    def load_bookkeeping(self):
         file_path = os.path.join(self.directory, self.bookkeeping)
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            return data[doc_id]
+                return json.load(f)
         except json.JSONDecodeError:
             print(f"Error: Invalid JSON in file {file_path}")
-            return None
+            return {}
         except FileNotFoundError:
             print(f"Error: File {file_path} not found")
-            return None
+            return {}
 
 
-    """lemmatizes the query and returns a dictionary of lemmas : frequencies"""
-    def tokenize_query(self, query):
-        lemmas = defaultdict(int)
-
-        content = re.sub('[^a-zA-Z0-9]', ' ', query)
+    """returns a list of urls associated with given doc_id"""
+    def get_url(self, doc_id):
+        return self.bookkeeping_map.get(doc_id)
 
-        for lemma in [l.lower() for l in nltk.word_tokenize(content)]:
-            if not (str(lemma).isnumeric()):
-                lemma = self.stemmer.stem(lemma)
-                lemmas[lemma] += 1
 
-        return lemmas
+    """lemmatizes the query and returns a dictionary of lemmas : frequencies"""
+    def tokenize_query(self, query):
+        return Counter(stem(token) for token in TOKEN_RE.findall(query.lower()) if not token.isdigit())
 
-    """calculates the normalized tf_idf for a query"""
+    """calculates the normalized tf_idf for a query, returning it with the
+    quantization scale of every query lemma found in the index"""
     def process_query(self, query):
         query_tfidf = defaultdict(float)                    # dictionary containing query terms and corresponding tf_idf values
         lemmas = self.tokenize_query(query)              
 
+        stats = {}                                          # {lemma : {idf, scale}}, one $in query for all lemmas
+        if lemmas:                                          # queries without searchable terms skip the database round-trip
+            stats = {entry['lemma']: entry for entry in
+                     self.collection.find({'lemma': {'$in': list(lemmas)}}, {'_id': 0, 'lemma': 1, 'idf': 1, 'scale': 1})}
+
         for lemma, tf in lemmas.items():                    # calculates the tf
             query_tfidf[lemma] = tf / len(lemmas)           # use the natural variant of tf
 
-        for lemma in query_tfidf:                           # calculates doc frequency
-            postings_list = self.collection.find_one({'lemma':lemma})['docs']       # log(total_docs / length of postings list)
-            doc_freq = log(self.total_docs / len(postings_list)) if postings_list else 0
-            query_tfidf[lemma] *= doc_freq
+        for lemma in query_tfidf:                           # idf = log(total_docs / length of postings list), stored at indexing
+            query_tfidf[lemma] *= stats[lemma]['idf'] if lemma in stats else 0
 
         vector_length = sqrt(sum(value ** 2 for value in query_tfidf.values()))     # normalize tf_idf values using Euclidean norm
+        scales = {lemma: entry['scale'] for lemma, entry in stats.items()}
 
-        return query_tfidf, vector_length
-
-    """calculates the length for each document vector"""
-    def normalize_doc_tfidf(self, doc_vector):
-        doc_vector_lengths = defaultdict(float)         # dictionary storing document_id and corresponding document vector length                                     
-
-        for doc_id, lemma in doc_vector.items():        # iterate through each document vector
-            doc_length = sqrt(sum(tf_idf ** 2 for tf_idf in lemma.values()))        # use Euclidean norm to calculate length
-            doc_vector_lengths[doc_id] = doc_length                                 # store length in the dictionary
-
-        return doc_vector_lengths
+        return query_tfidf, vector_length, scales
 
     """calculates cosine similarity between query and documents and returns
     the top 20 documents with the highest score"""
+    # scored inside mongodb so postings lists never leave the server
+    # (documentation: https://www.mongodb.com/docs/manual/reference/operator/aggregation/group/)
     def calculate_cosine_similarity(self, query):
-        scores = defaultdict(float)                                     # stores cosine similarity scores
-        query_tfidf, query_vector_length = self.process_query(query)    
-
-        doc_vectors = defaultdict(lambda: defaultdict(list))            # structure is a nested dict: {doc_id : {lemma : list of tf_idf}}
-
-        for lemma in query_tfidf.keys():                                # iterating through each lemma in the query
-            postings_list = self.collection.find_one({'lemma': lemma})['docs']      # retrieve postings list
-
-            for doc in postings_list:                                   # for each document in the postings list
-                doc_id = doc['location']
-                tf_idf = doc.get('tf_idf', doc['tf'] / log(self.total_docs / len(postings_list)))       # retrieve tf_idf value
-                doc_vectors[doc_id][lemma] = tf_idf
-                scores[doc_id] += doc['html_weight'] / 10000            # add html weight to score (/1000 for mininmal impact)
-
-        self.normalize_doc_tfidf(doc_vectors)                           # normalize document scores
-
-        for doc_id, data in doc_vectors.items():                        # for each document
-            cosine_similarity = 0.0
-
-            for lemma, tf_idf in data.items():                          # for each query lemma
-                cosine_similarity += query_tfidf[lemma] * tf_idf        # accumulate cosine similarity score
-
-            scores[doc_id] += cosine_similarity                         # accumulate total score (takes into account multiple term queries)
-
-        sorted_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)    # sort by accumulated cosine similarity score
-        top_docs = [doc_id for doc_id, _ in sorted_scores[:20]]                     # return the doc_id for the 20 highest scores
-
-        return top_docs
\ No newline at end of file
+        query_tfidf, query_vector_length, scales = self.process_query(query)
+        if not scales:                                              # nothing in the index matches the query
+            return []
+
+        weights = [{'case': {'$eq': ['$lemma', lemma]}, 'then': query_tfidf[lemma] * scale}       # folds in the dequantization scale
+                   for lemma, scale in scales.items()]
+        pipeline = [
+            {'$match': {'lemma': {'$in': list(scales)}}},
+            {'$project': {'_id': 0, 'docs': 1, 'weight': {'$switch': {'branches': weights, 'default': 0}}}},
+            {'$unwind': '$docs'},                                                                   # one entry per (lemma, doc) pair
+            {'$group': {'_id': '$docs.location',
+                        'score': {'$sum': {'$multiply': ['$weight', '$docs.tf_idf']}},             # cosine similarity numerator
+                        'html_weight': {'$sum': '$docs.html_weight'}}},
+            {'$project': {'score': {'$add': [
+                {'$divide': ['$score', query_vector_length or 1]},                                  # documents are stored normalized, divide by query length (0 when every lemma has idf 0)
+                {'$divide': ['$html_weight', 10000]}]}}},                                           # add html weight to score (/10000 for minimal impact)
+            {'$sort': {'score': -1, '_id': 1}},
+            {'$limit': 20}]                                                                         # the 20 highest scores
+
+        return [doc['_id'] for doc in self.collection.aggregate(pipeline)]
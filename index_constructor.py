@@ -1,22 +1,20 @@
 import json
 import os
-import re
-import nltk
-import warnings
-from bs4 import BeautifulSoup
-from bs4 import MarkupResemblesLocatorWarning
-from bs4 import XMLParsedAsHTMLWarning
+import lxml.html
+from lxml import etree
 from pymongo import UpdateOne
-from collections import defaultdict
-from basic_query import BasicQuery
-from nltk.stem.snowball import EnglishStemmer
+from collections import Counter, defaultdict
+from basic_query import BasicQuery, TOKEN_RE, stem
 from pymongo.errors import BulkWriteError, CursorNotFound
-from math import log
 from motor.motor_asyncio import AsyncIOMotorClient
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 
-warnings.filterwarnings("ignore", category = MarkupResemblesLocatorWarning)
-warnings.filterwarnings("ignore", category = XMLParsedAsHTMLWarning)
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stop_words.txt')) as f:
+    STOP_WORDS = frozenset(f.read().split())        # loaded once at import, file lists several words per line
+
+NON_CONTENT_TAGS = frozenset(('script', 'style'))     # tags whose text is code rather than page content
+TF_IDF_LEVELS = 32767       # tf_idf is stored as a 16-bit range integer per posting plus one float scale per lemma
 
 """use mongodb to store the inverted index
     https://pymongo.readthedocs.io/en/stable/tutorial.html
@@ -32,74 +30,114 @@ class InvertedIndex:
         self.client = AsyncIOMotorClient("localhost", 27017)
         self.db = self.client.search_engine
         self.collection = self.db.inverted_index
-        self.stemmer = EnglishStemmer()
-        self.stopWords = set(line.strip() for line in open('stop_words.txt'))
         self.htmlWeights = {'title':0.6, 'h1':0.5, 'h2':0.4, 'h3':0.3, 'h4':0.2}
+        self.inverted = defaultdict(list)       # in-memory inverted index: {lemma : postings list}
+        self.write_chunk = 1000                 # number of lemmas written per bulk_write
 
 
     """iterates through the corpus and processes each document"""
     async def build_index(self):
-        if self.collection.count_documents({}) == 0:    # checks if the index is already built
+        await self.collection.create_index('lemma', unique = True)      # one entry per lemma, backs every lemma lookup
+        if await self.collection.count_documents({}) == 0:    # checks if the index is already built
             print("Index is empty. Building index...")
-            big_dir = json.load(open(self.jf, encoding = "utf-8"))
-            semaphore = asyncio.Semaphore(3)            # max of 3 concurrent tasks
+            with open(self.jf, encoding = "utf-8") as f:
+                big_dir = json.load(f)
+            semaphore = asyncio.Semaphore(16)           # max of 16 concurrent tasks
+            loop = asyncio.get_running_loop()
+
+            with ThreadPoolExecutor() as executor:      # parses html in worker threads so file reads overlap
+                async def process_dir(directory):
+                    async with semaphore:
+                        folder, file = directory.split("/")
+                        file_path = os.path.join(".", self.html_dir, folder, file)
 
-            async def process_dir(directory):
-                async with semaphore:
-                    folder, file = directory.split("/")
-                    file_path = os.path.join(".", self.html_dir, folder, file)
-                    soup = BeautifulSoup(open(file_path, 'r', encoding = 'utf-8'), 'lxml')
+                        lemmas = await loop.run_in_executor(executor, self.parse_document, file_path)   # dict of lemma, freq, html_weight
+                        self.add_to_index(lemmas, folder, file)
 
-                    lemmas = self.process_document(soup)                # lemmas is a dict containing lemma, freq, html_weight
-                    await self.add_to_index(lemmas, folder, file)
+                tasks = [process_dir(directory) for directory in big_dir]   # create a task for each directory and run them concurrently
 
-            tasks = [process_dir(directory) for directory in big_dir]   # create a task for each directory and run them concurrently
+                await asyncio.gather(*tasks)        # makes sure that all tasks have been completed before continuing
 
-            await asyncio.gather(*tasks)            # makes sure that all tasks have been completed before continuing
+            await self.write_index()                # writes the complete postings lists to the database
             await self.calculate_tf_idf()           # adds tf_idf values to the database
             await self.generate_analytics()         # generates the analytics for milestone 1
 
 
-    """generates a dictionary containing lemmas, frequencies, and html weights for each document"""
-    def process_document(self, soup):
-        lemmas = defaultdict(lambda: {'freq': 0, 'html_weight': 0})        # stores frequency and html weight
+    """parses the html file at file_path and returns its lemmas"""
+    def parse_document(self, file_path):
+        try:
+            tree = lxml.html.parse(file_path, parser = lxml.html.HTMLParser(encoding = 'utf-8'))   # parser per call, lxml parsers aren't thread safe
+        except (etree.ParserError, etree.XMLSyntaxError):      # empty or unparseable documents have no lemmas
+            return {}
+        root = tree.getroot()
+        return self.process_document(root) if root is not None else {}
+
 
-        for tag in soup.find_all(True):                                    # retrieves all tags in the html document
-            tag_name = tag.name                                            # tag.name gets the html tag type (ex. h1, h2, etc.)
+    """generates a dictionary containing lemmas, frequencies, and html weights for each document"""
+    def process_document(self, root):
+        counts = defaultdict(Counter)                                      # {html weight : lemma frequencies}, few distinct weights
+
+        for string in root.xpath('//text()'):                              # retrieves every text node in the html document once
+            tag = string.getparent()
+            if string.is_tail:                                             # text after a closing tag belongs to the enclosing tag
+                tag = tag.getparent()
+            if tag is None or not isinstance(tag.tag, str):               # skips comments and processing instructions
+                continue
+            tag_name = tag.tag                                             # the text's own tag type (ex. h1, h2, etc.), not its ancestors
+            if tag_name in NON_CONTENT_TAGS:                               # skips javascript and css
+                continue
             html_weight = self.htmlWeights.get(tag_name, 0.1)              # assign weight depending on tag, default to 1
-            content = re.sub('[^a-zA-Z0-9]', ' ', tag.text)                # extracts the actual textual content
+            content = string.lower()                                       # extracts the actual textual content
+
+            counts[html_weight].update(stem(token) for token in TOKEN_RE.findall(content)     # skip short words, stop words and numbers
+                                       if len(token) > 2 and token not in STOP_WORDS and not token.isdigit())
 
-            for lemma in [l.lower() for l in nltk.word_tokenize(content) if (not l.lower() in self.stopWords) and len(l) > 2]:
-                if not (str(lemma).isnumeric()):
-                    lemma = self.stemmer.stem(lemma)
-                    lemmas[lemma]['freq'] += 1                           # update frequency of each lemma
-                    lemmas[lemma]['html_weight'] += html_weight          # update html weight of each lemma
+        lemmas = {}                                                        # stores frequency and html weight
+        for html_weight, freqs in counts.items():
+            for lemma, freq in freqs.items():
+                entry = lemmas.setdefault(lemma, {'freq': 0, 'html_weight': 0})
+                entry['freq'] += freq                                      # update frequency of each lemma
+                entry['html_weight'] += html_weight * freq                 # update html weight of each lemma
 
         return lemmas
 
 
-    """writes each document's data to the mongo database"""
-    async def add_to_index(self, lemmas, folder, file):
+    """adds each document's data to the in-memory inverted index"""
+    def add_to_index(self, lemmas, folder, file):
         total_words = len(lemmas)
-        updates = []
+        doc_id = f"{folder}/{file}"
 
-        print(f'Adding {folder}/{file} to DB ({self.num_documents})')
-        for lemma, data in lemmas.items():                                                      # adds each lemma to the database
-            doc_id = f"{folder}/{file}"
+        print(f'Adding {folder}/{file} to index ({self.num_documents})')
+        for lemma, data in lemmas.items():                                                      # adds each lemma to its postings list
             tf = data['freq'] / total_words
             html_weight = data['html_weight']
-            doc_entry = {'location': doc_id, 'tf': tf, 'html_weight': html_weight}
-            updates.append(
-                UpdateOne({'lemma': lemma}, {'$push': {'docs': doc_entry}}, upsert = True))     # use bulk updating to reduce writing time
+            self.inverted[lemma].append({'location': doc_id, 'tf': tf, 'html_weight': html_weight})
+
+        if lemmas:
+            self.num_documents += 1
+
 
-        if updates:  # check if the updates list is not empty
+    """writes the in-memory inverted index to the mongo database, one operation per lemma"""
+    async def write_index(self):
+        updates = [UpdateOne({'lemma': lemma}, {'$set': {'docs': postings}}, upsert = True)
+                   for lemma, postings in self.inverted.items()]
+
+        for i in range(0, len(updates), self.write_chunk):                  # use bulk updating to reduce writing time
+            await self.flush_updates(updates[i:i + self.write_chunk])
+
+        print(f"Wrote {len(updates)} postings lists to DB.")
+        self.inverted.clear()
+
+
+    """writes a batch of updates to the mongo database"""
+    async def flush_updates(self, batch):
+        if batch:
             try:
-                await asyncio.wait_for(self.collection.bulk_write(updates), timeout=20)
-                self.num_documents += 1
+                await asyncio.wait_for(self.collection.bulk_write(batch, ordered = False), timeout=60)   # unordered lets mongo pipeline the writes
             except asyncio.TimeoutError:
                 print("The operation timed out")
             except BulkWriteError as e:
-                print("Error adding lemmas from directory:", doc_id)
+                print("Error adding lemmas to the index:", e.details.get('writeErrors', [])[:1])
             except Exception as e:
                 print(f"Write operation error: {e}")
             except KeyboardInterrupt:
@@ -107,33 +145,64 @@ class InvertedIndex:
 
 
     """calculates the tf_idf for each term/doc given the database"""
-    # use a cursor to iterate through database (documentation: https://www.mongodb.com/docs/manual/tutorial/iterate-a-cursor/)
+    # runs entirely inside mongodb (documentation: https://www.mongodb.com/docs/manual/reference/operator/aggregation/map/)
     async def calculate_tf_idf(self):
-        total_docs = len(self.collection.distinct("docs.location"))
-        cursor = self.collection.find()
-
-        async for entry in cursor:                          # iterates through each entry in the database
-            lemma = entry['lemma']
-            df = len(entry['docs'])
-            idf = log(total_docs / df) if df > 0 else 0
-            updates = []
-
-            for doc in entry['docs']:                       # iterates through each document in the postings list for a lemma
-                location = doc['location']
-                tf_idf = doc['tf'] * idf                    # uses previously stored tf values and calculated idf for each lemma
-                print(f"Calculated tf_idf for {lemma}, {location}: {tf_idf}")
-
-                updates.append(                             # updates database to include tf_idf values
-                    UpdateOne(
-                        {'lemma': lemma, 'docs.location': location},
-                        {'$set': {'docs.$.tf_idf': tf_idf}}, upsert = True))
-                
-            try:
-                self.collection.bulk_write(updates)
-            except Exception as e:
-                print("Error calculating tf_idf:", e)
-
-        print("tf_idf calculations complete.")
+        total_docs = self.num_documents                                                         # every indexed document has a postings entry
+        pipeline = [
+            {'$addFields': {'idf': {'$ln': {'$divide': [total_docs, {'$size': '$docs'}]}}}},      # log(total_docs / df)
+            {'$addFields': {'docs': {'$map': {                                                  # tf_idf = tf * idf for each posting
+                'input': '$docs',
+                'as': 'd',
+                'in': {'location': '$$d.location', 'tf': '$$d.tf', 'html_weight': '$$d.html_weight',
+                       'tf_idf': {'$multiply': ['$$d.tf', '$idf']}}}}}},
+            {'$out': 'inverted_index'}]
+
+        if total_docs:
+            await self.collection.aggregate(pipeline).to_list(None)
+            print("tf_idf calculations complete.")
+            await self.calculate_doc_norms()
+            await self.normalize_tf_idf()
+
+
+    """stores the length of each document vector in the doc_norms collection"""
+    # documentation on $out: https://www.mongodb.com/docs/manual/reference/operator/aggregation/out/
+    async def calculate_doc_norms(self):
+        pipeline = [
+            {'$unwind': '$docs'},                                                           # one entry per (lemma, doc) pair
+            {'$group': {'_id': '$docs.location', 'sqnorm': {'$sum': {'$pow': ['$docs.tf_idf', 2]}}}},
+            {'$project': {'norm': {'$sqrt': '$sqnorm'}}},                                   # Euclidean norm of the document vector
+            {'$out': 'doc_norms'}]
+
+        await self.collection.aggregate(pipeline).to_list(None)
+        print("Document norm calculations complete.")
+
+
+    """divides each tf_idf by its document's vector length so queries need no normalization pass,
+    then stores it as an integer quantized per lemma: weight = docs.tf_idf * scale"""
+    # documentation on $lookup: https://www.mongodb.com/docs/manual/reference/operator/aggregation/lookup/
+    async def normalize_tf_idf(self):
+        pipeline = [
+            {'$unwind': '$docs'},                                                           # one entry per (lemma, doc) pair
+            {'$lookup': {'from': 'doc_norms', 'localField': 'docs.location', 'foreignField': '_id', 'as': 'norm'}},
+            {'$addFields': {'docs.tf_idf': {'$let': {                                       # tf_idf / document length
+                'vars': {'norm': {'$ifNull': [{'$arrayElemAt': ['$norm.norm', 0]}, 0]}},
+                'in': {'$cond': [{'$gt': ['$$norm', 0]}, {'$divide': ['$docs.tf_idf', '$$norm']}, 0]}}}}},
+            {'$group': {'_id': '$_id', 'lemma': {'$first': '$lemma'}, 'idf': {'$first': '$idf'},
+                        'docs': {'$push': '$docs'}, 'max_weight': {'$max': '$docs.tf_idf'}}},
+            {'$addFields': {
+                'scale': {'$divide': ['$max_weight', TF_IDF_LEVELS]},                       # value of one quantization step
+                'docs': {'$map': {                                                          # weight / scale, rounded, for each posting
+                    'input': '$docs',
+                    'as': 'd',
+                    'in': {'location': '$$d.location', 'html_weight': '$$d.html_weight',      # tf isn't needed once tf_idf is stored
+                           'tf_idf': {'$cond': [{'$gt': ['$max_weight', 0]},
+                                                {'$toInt': {'$add': [{'$divide': [{'$multiply': ['$$d.tf_idf', TF_IDF_LEVELS]}, '$max_weight']}, 0.5]}},
+                                                0]}}}}}},
+            {'$project': {'max_weight': 0}},
+            {'$out': 'inverted_index'}]
+
+        await self.collection.aggregate(pipeline, allowDiskUse = True).to_list(None)      # $group over every posting may exceed the memory limit
+        print("tf_idf normalization complete.")
 
 
     """generates analytics for milestone 1"""